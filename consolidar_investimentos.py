@@ -1,13 +1,76 @@
 import pandas as pd
+import numpy as np
 import os
 from datetime import datetime
 import warnings
 import configparser
+import re
+import functools
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import yfinance as yf
-import xlsxwriter # Required for formatting, though pd.ExcelWriter handles the writing
+import xlsxwriter
+import openpyxl
 
 # docker build -t consolidador-investimentos .
 
+# pyarrow backs both the Parquet cache of parsed statements and the polars reader's conversion to pandas
+try:
+    import pyarrow # noqa: F401 - used through DataFrame.to_parquet/pd.read_parquet and polars' to_pandas
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Parsed statements are cached as Parquet when pyarrow is available
+PARQUET_CACHE_ENABLED = PYARROW_AVAILABLE
+# Part of every cache key; bump it whenever _parse_one changes the shape or dtypes of what it returns
+CACHE_FORMAT_VERSION = 1
+
+# Pick the fastest available spreadsheet reader: polars (calamine straight into Arrow columns),
+# then pandas' calamine engine (pandas >= 2.2), then openpyxl
+EXCEL_READ_ENGINE = None
+if PYARROW_AVAILABLE:
+    try:
+        import polars as pl
+        import fastexcel # noqa: F401 - calamine backend used by pl.read_excel
+        EXCEL_READ_ENGINE = "polars"
+    except ImportError:
+        pass
+if EXCEL_READ_ENGINE is None:
+    try:
+        import python_calamine # noqa: F401 - only checked for availability, used through pd.read_excel
+        EXCEL_READ_ENGINE = "calamine"
+    except ImportError:
+        EXCEL_READ_ENGINE = "openpyxl"
+
+# Prefer PyExcelerate for writing the output workbook and fall back to xlsxwriter if it is not installed
+try:
+    import pyexcelerate
+    EXCEL_WRITE_ENGINE = "pyexcelerate"
+except ImportError:
+    EXCEL_WRITE_ENGINE = "xlsxwriter"
+
+# Copy-on-Write makes filtered frames behave as independent copies without eagerly duplicating data.
+# It is always on from pandas 3.0, where the option is deprecated.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# Ticker code at the start of a 'Produto' description, e.g. "PETR4 - PETROLEO BRASILEIRO S.A."
+_TICKER_RE = re.compile(r"^([^\s-]+)")
+
+# 'Movimentação' types that change the position, mapped to their effect on it
+POSITION_TRANSACTION_TYPES = {
+    "Compra": "Buy",
+    "Venda": "Sell",
+    "Transferência - Liquidação": "Transfer_Settlement",
+    "Leilão de Fração": "Buy", 
+    "Bonificação em Ativos": "Buy", 
+    "Fração em Ativos": "Sell" 
+}
+
+# 'Movimentação' types that count as income (dividends, JCP and FII distributions)
+INCOME_TYPES = ["Dividendo", "Juros Sobre Capital Próprio", "Rendimento"]
+
 # Ignore the specific UserWarning from openpyxl related to data validation
 warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
 
@@ -35,38 +98,158 @@ def load_config(config_file="input/config/config.ini"):
     config.read(config_file)
     return config
 
+# --- Helper to open workbooks in openpyxl's streaming mode ---
+def _open_xlsx(path):
+    """
+    Opens an .xlsx workbook in read-only mode with cached values instead of formulas.
+    The caller is responsible for closing the returned workbook.
+    """
+    return openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+def _read_xlsx(path, **kwargs):
+    """
+    Reads an .xlsx file into a DataFrame using EXCEL_READ_ENGINE.
+    Extra keyword arguments are forwarded to pd.read_excel; with polars only
+    sheet_name and dtype are supported, and the result is converted to pandas.
+    """
+    if EXCEL_READ_ENGINE == "polars":
+        dtype = kwargs.pop("dtype", None)
+        df = pl.read_excel(path, sheet_name=kwargs.pop("sheet_name", None), engine="calamine").to_pandas()
+        if dtype:
+            # Like pd.read_excel, ignore dtype entries for columns the sheet does not have
+            df = df.astype({col: col_type for col, col_type in dtype.items() if col in df.columns})
+        return df
+
+    if EXCEL_READ_ENGINE == "calamine":
+        return pd.read_excel(path, engine="calamine", **kwargs)
+
+    workbook = _open_xlsx(path)
+    try:
+        return pd.read_excel(workbook, engine="openpyxl", **kwargs)
+    finally:
+        workbook.close()
+
+# --- Cache of parsed statement files ---
+def _cache_path(file_path, file_stat=None):
+    """
+    Returns the Parquet cache path for a statement file, in a '.cache' folder next to it.
+    The key changes whenever the file is modified, the reader engine changes or CACHE_FORMAT_VERSION
+    is bumped, so stale entries are never read.
+    file_stat can be passed to reuse a stat result already obtained from os.scandir.
+    """
+    stat = file_stat if file_stat is not None else os.stat(file_path)
+    key_source = f"{CACHE_FORMAT_VERSION}|{EXCEL_READ_ENGINE}|{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    key = hashlib.blake2b(key_source.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(file_path), ".cache", f"{key}.parquet")
+
+def _write_cache(df, cache_path):
+    """
+    Stores a parsed statement in the Parquet cache. Failures only cost a re-parse on the next run.
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        df.to_parquet(cache_path, compression="zstd")
+    except Exception as e:
+        print(f"WARNING: Could not write cache file '{cache_path}': {e}")
+
+def _prune_cache(cache_dir, current_cache_paths):
+    """
+    Removes cache entries that do not belong to any current statement file
+    (edited, replaced or deleted statements, or an older cache format/engine).
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    keep = {os.path.abspath(path) for path in current_cache_paths}
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".parquet") and os.path.abspath(entry.path) not in keep:
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"WARNING: Could not remove stale cache file '{entry.path}': {e}")
+
+# --- Function to read a single statement file ---
+def _parse_one(file_path, file_stat=None):
+    """
+    Loads the 'Movimentação' sheet of a single statement file.
+    Unchanged files are read from the Parquet cache instead of being parsed again.
+    Returns None if the file cannot be used, so it can be skipped by the caller.
+    """
+    cache_path = _cache_path(file_path, file_stat) if PARQUET_CACHE_ENABLED else None
+    if cache_path and os.path.exists(cache_path):
+        print(f"Reading file: {file_path} (cached)")
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            print(f"WARNING: Could not read cache file '{cache_path}': {e}. Parsing the original file.")
+
+    print(f"Reading file: {file_path}")
+    try:
+        df = _read_xlsx(file_path, sheet_name="Movimentação")
+        # Ensure 'Data' and 'Preço unitário' columns exist before processing
+        if "Data" not in df.columns or "Preço unitário" not in df.columns:
+            print(f"WARNING: File '{file_path}' does not contain 'Data' or 'Preço unitário' columns in the 'Movimentação' sheet. Skipping this file.")
+            return None
+
+        df["Data"] = pd.to_datetime(df["Data"], dayfirst=True)
+        df["Preço unitário"] = pd.to_numeric(df["Preço unitário"], errors="coerce")
+        # Statements mark missing amounts with '-', so numeric columns are coerced here to keep them Parquet-friendly
+        for col in ("Quantidade", "Valor da Operação"):
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+        if cache_path:
+            _write_cache(df, cache_path)
+        return df
+    except KeyError:
+        print(f"WARNING: File '{file_path}' does not have the 'Movimentação' sheet. Skipping this file.")
+    except Exception as e:
+        print(f"ERROR reading file {file_path}: {e}. Skipping this file.")
+    return None
+
 # --- Function to read all transaction data from the input folder ---
 def load_transactions_from_folder(folder_path):
     """
     Loads all 'Movimentação' sheets from .xlsx files in the specified folder.
+    Files are parsed in parallel worker processes when there is more than one.
     """
     if not os.path.exists(folder_path):
         print(f"WARNING: Input folder '{folder_path}' not found. Please create it and place your Excel statement files there.")
         return pd.DataFrame() # Return empty DataFrame if folder doesn't exist
 
-    excel_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith(".xlsx")]
-    if not excel_files:
+    # Excel lock files ('~$name.xlsx') left by open workbooks are not statements
+    with os.scandir(folder_path) as entries:
+        excel_entries = [
+            (entry.path, entry.stat()) for entry in entries
+            if entry.is_file() and entry.name.endswith(".xlsx") and not entry.name.startswith("~$")
+        ]
+    if not excel_entries:
         print(f"WARNING: No .xlsx files found in folder '{folder_path}'. Please place your statements here.")
         return pd.DataFrame()
 
-    all_transactions_df = pd.DataFrame()
-    for file_path in excel_files:
-        print(f"Reading file: {file_path}")
-        try:
-            df = pd.read_excel(file_path, sheet_name="Movimentação", engine="openpyxl")
-            # Ensure 'Data' and 'Preço unitário' columns exist before processing
-            if "Data" not in df.columns or "Preço unitário" not in df.columns:
-                print(f"WARNING: File '{file_path}' does not contain 'Data' or 'Preço unitário' columns in the 'Movimentação' sheet. Skipping this file.")
-                continue
-
-            df["Data"] = pd.to_datetime(df["Data"], dayfirst=True)
-            df["Preço unitário"] = pd.to_numeric(df["Preço unitário"], errors="coerce")
-            all_transactions_df = pd.concat([all_transactions_df, df], ignore_index=True)
-        except KeyError:
-            print(f"WARNING: File '{file_path}' does not have the 'Movimentação' sheet. Skipping this file.")
-        except Exception as e:
-            print(f"ERROR reading file {file_path}: {e}. Skipping this file.")
-    return all_transactions_df
+    excel_files, excel_stats = zip(*excel_entries)
+    max_workers = min(len(excel_files), os.cpu_count() or 1)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parsed = list(executor.map(_parse_one, excel_files, excel_stats))
+    else:
+        parsed = [_parse_one(file_path, file_stat) for file_path, file_stat in excel_entries]
+
+    if PARQUET_CACHE_ENABLED:
+        # Runs after all cache writes, so only entries of the statements just loaded survive
+        _prune_cache(os.path.join(folder_path, ".cache"), [_cache_path(file_path, file_stat) for file_path, file_stat in excel_entries])
+
+    frames = [df for df in parsed if df is not None] # Concatenate all usable files once at the end
+    if not frames:
+        return pd.DataFrame()
+
+    transactions_df = pd.concat(frames, ignore_index=True)
+    # Low-cardinality text columns are stored as categoricals to save memory and speed up filters/groupbys
+    for col in ("Movimentação", "Entrada/Saída", "Produto"):
+        if col in transactions_df.columns:
+            transactions_df[col] = transactions_df[col].astype("category")
+    if "Produto" in transactions_df.columns:
+        transactions_df["Ticker"] = transactions_df["Produto"].str.extract(_TICKER_RE, expand=False) # Extract ticker once for all steps
+    return transactions_df
 
 # --- Function to load stock splits/groupings ---
 def load_splits_and_groupings(file_path):
@@ -78,7 +261,7 @@ def load_splits_and_groupings(file_path):
         return pd.DataFrame()
     print(f"Reading splits/groupings file: {file_path}")
     try:
-        df = pd.read_excel(file_path, engine="openpyxl")
+        df = _read_xlsx(file_path, dtype={"Ticker": "string"})
         # Ensure required columns exist
         if not all(col in df.columns for col in ["Ticker", "Fator", "Data"]):
             print(f"WARNING: File '{file_path}' does not contain all required columns (Ticker, Fator, Data). Skipping splits/groupings.")
@@ -101,28 +284,56 @@ def apply_splits_and_groupings(transactions_df, cutoff_date, splits_df):
         return transactions_df
 
     print("Applying splits/groupings...")
-    df_copy = transactions_df.copy() # Work on a copy to avoid SettingWithCopyWarning
+    df_copy = transactions_df.copy(deep=False) # Shallow copy: with Copy-on-Write, column writes never reach the caller's frame
 
     # Ensure date columns are datetime type for comparison
     df_copy["Data"] = pd.to_datetime(df_copy["Data"])
-    splits_df["Data"] = pd.to_datetime(splits_df["Data"])
+    splits_df = splits_df.assign(Data=pd.to_datetime(splits_df["Data"]))
     cutoff_date_dt = pd.to_datetime(cutoff_date)
 
-    for _, row in splits_df.iterrows():
-        ticker, factor, split_date = row["Ticker"], row["Fator"], row["Data"]
+    applicable_splits = splits_df[splits_df["Data"] <= cutoff_date_dt]
+    for _, row in splits_df[splits_df["Data"] > cutoff_date_dt].iterrows():
+        print(f"Split/grouping for {row['Ticker']} on {row['Data'].strftime('%Y-%m-%d')} ignored (after cutoff date {cutoff_date_dt.strftime('%Y-%m-%d')}).")
 
-        # Check if the split date is on or before the cutoff date
-        if split_date <= cutoff_date_dt:
-            # Filter transactions that match the ticker and occurred
-            # on or before the split date.
-            filter_condition = df_copy["Produto"].str.contains(ticker, na=False) & \
-                                 (df_copy["Data"] <= split_date)
+    if applicable_splits.empty:
+        return df_copy
 
-            # Apply the split factor to Quantity and Unit Price
-            df_copy.loc[filter_condition, "Quantidade"] *= factor
-            df_copy.loc[filter_condition, "Preço unitário"] /= factor
-        else:
-            print(f"Split/grouping for {ticker} on {split_date.strftime('%Y-%m-%d')} ignored (after cutoff date {cutoff_date_dt.strftime('%Y-%m-%d')}).")
+    # A transaction is affected by every split of its ticker on or after its date, so the
+    # factor to apply is the product of those splits (a suffix product per ticker).
+    split_factors = (
+        applicable_splits.assign(Ticker=applicable_splits["Ticker"].astype("string"))
+        .groupby(["Ticker", "Data"])["Fator"].prod()
+        .reset_index()
+        .sort_values(["Ticker", "Data"], ascending=[True, False])
+    )
+    split_factors["Fator Acumulado"] = split_factors.groupby("Ticker")["Fator"].cumprod()
+    split_factors["Data"] = split_factors["Data"].astype(df_copy["Data"].dtype) # merge_asof needs matching datetime units
+
+    transactions_keys = pd.DataFrame({
+        "Ticker": df_copy["Ticker"].astype("string"),
+        "Data": df_copy["Data"],
+        "Posição": np.arange(len(df_copy))
+    }).dropna(subset=["Ticker", "Data"])
+    # Only transactions of tickers with splits take part in the sort and join
+    transactions_keys = transactions_keys[transactions_keys["Ticker"].isin(split_factors["Ticker"])]
+    if transactions_keys.empty:
+        return df_copy
+
+    # Attach the first split on or after each transaction date, carrying its cumulative factor
+    matched = pd.merge_asof(
+        transactions_keys.sort_values("Data"),
+        split_factors[["Ticker", "Data", "Fator Acumulado"]].sort_values("Data"),
+        on="Data",
+        by="Ticker",
+        direction="forward"
+    )
+    factor_dtype = split_factors["Fator Acumulado"].dtype
+    cumulative_factor = np.ones(len(df_copy), dtype=factor_dtype)
+    cumulative_factor[matched["Posição"].to_numpy()] = matched["Fator Acumulado"].fillna(1).to_numpy(dtype=factor_dtype)
+
+    # Apply the split factor to Quantity and Unit Price
+    df_copy["Quantidade"] = df_copy["Quantidade"] * cumulative_factor
+    df_copy["Preço unitário"] = df_copy["Preço unitário"] / cumulative_factor
     return df_copy
 
 def apply_ticker_renames(transactions_df, renames_file_path):
@@ -136,7 +347,7 @@ def apply_ticker_renames(transactions_df, renames_file_path):
             print(f"WARNING: Renames file '{renames_file_path}' not found. Skipping renames.")
             return transactions_df
 
-        renames_df = pd.read_excel(renames_file_path, engine="openpyxl")
+        renames_df = _read_xlsx(renames_file_path, dtype={"Ticker Antigo": "string", "Ticker Novo": "string"})
         if not all(col in renames_df.columns for col in ["Ticker Antigo", "Ticker Novo"]):
             print(f"WARNING: File '{renames_file_path}' does not contain 'Ticker Antigo' and 'Ticker Novo' columns. Skipping renames.")
             return transactions_df
@@ -145,7 +356,9 @@ def apply_ticker_renames(transactions_df, renames_file_path):
         
         # Ensure 'Ticker' column exists before trying to replace values in it
         if "Ticker" in transactions_df.columns:
-            transactions_df["Ticker"] = transactions_df["Ticker"].replace(rename_map)
+            # Hash lookup per ticker; tickers without a rename keep their original value
+            renamed = transactions_df["Ticker"].map(rename_map)
+            transactions_df["Ticker"] = renamed.where(renamed.notna(), transactions_df["Ticker"])
         else:
             print("WARNING: 'Ticker' column not found in transactions_df. Cannot apply renames.")
             
@@ -153,10 +366,38 @@ def apply_ticker_renames(transactions_df, renames_file_path):
         print(f"ERROR applying renames: {e}. Renames will not be applied.")
     return transactions_df
 
+# --- Prepare transactions for the consolidation steps ---
+def prepare_transactions(transactions_df):
+    """
+    Coerces the numeric columns once and splits the transactions into the slices used downstream.
+    Returns a dict with keys "buys_sells" (consolidate_position), "income" (consolidate_income)
+    and "sales" (consolidate_sales).
+    """
+    if transactions_df.empty:
+        return {"buys_sells": transactions_df, "income": transactions_df, "sales": transactions_df}
+
+    df = transactions_df.copy(deep=False) # Shallow copy: with Copy-on-Write, column writes never reach the caller's frame
+    # Monetary columns stay float64: float32 cannot hold cents exactly beyond ~R$ 100k
+    for col in ("Preço unitário", "Valor da Operação"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    # Whole share counts are narrowed to the smallest integer type; fractional or missing ones stay float64
+    if "Quantidade" in df.columns:
+        df["Quantidade"] = pd.to_numeric(df["Quantidade"], errors="coerce", downcast="integer")
+
+    movement = df["Movimentação"]
+    is_sale = (movement == "Venda") | ((movement == "Transferência - Liquidação") & (df["Entrada/Saída"] == "Debito"))
+    return {
+        "buys_sells": df[movement.isin(POSITION_TRANSACTION_TYPES.keys())],
+        "income": df[movement.isin(INCOME_TYPES)],
+        "sales": df[is_sale]
+    }
+
 # --- Consolidate position up to a certain date ---
 def consolidate_position(transactions_df, cutoff_date, renames_file_path):
     """
     Consolidates the investment position up to the cutoff date.
+    Expects the "buys_sells" slice returned by prepare_transactions.
     Returns a DataFrame with columns: ["Ativo", "Quantidade", "Preço Médio", "Custo Total"]
     """
     print("Consolidating positions...")
@@ -166,71 +407,67 @@ def consolidate_position(transactions_df, cutoff_date, renames_file_path):
         print("No transactions to consolidate position.")
         return pd.DataFrame(columns=pt_columns_position)
 
-    df_filtered = transactions_df[transactions_df["Data"] <= pd.to_datetime(cutoff_date)].copy()
-
-    valid_transaction_types = {
-        "Compra": "Buy",
-        "Venda": "Sell",
-        "Transferência - Liquidação": "Transfer_Settlement",
-        "Leilão de Fração": "Buy", 
-        "Bonificação em Ativos": "Buy", 
-        "Fração em Ativos": "Sell" 
-    }
-
-    df_filtered = df_filtered[df_filtered["Movimentação"].isin(valid_transaction_types.keys())].copy()
+    df_filtered = transactions_df[transactions_df["Data"] <= pd.to_datetime(cutoff_date)]
 
     if df_filtered.empty:
         print("No valid transactions after filtering to consolidate position.")
         return pd.DataFrame(columns=pt_columns_position)
 
-    df_filtered["Type"] = df_filtered.apply(lambda row: (
-        "Buy" if valid_transaction_types[row["Movimentação"]] == "Transfer_Settlement" and row["Entrada/Saída"] == "Credito"
-        else "Sell" if valid_transaction_types[row["Movimentação"]] == "Transfer_Settlement" and row["Entrada/Saída"] == "Debito"
-        else valid_transaction_types[row["Movimentação"]]
-    ), axis=1)
+    # Transfers are resolved to Buy/Sell by their direction; every other type maps directly
+    mapped_type = df_filtered["Movimentação"].map(POSITION_TRANSACTION_TYPES)
+    is_transfer = mapped_type.eq("Transfer_Settlement")
+    df_filtered["Type"] = np.select(
+        [is_transfer & df_filtered["Entrada/Saída"].eq("Credito"), is_transfer & df_filtered["Entrada/Saída"].eq("Debito")],
+        ["Buy", "Sell"],
+        default=mapped_type.to_numpy(dtype=object)
+    )
 
     df_filtered["Quantidade"] = df_filtered["Quantidade"].fillna(0)
-    df_filtered["Preço unitário"] = pd.to_numeric(df_filtered["Preço unitário"].fillna(0), errors='coerce') 
-    df_filtered["Ticker"] = df_filtered["Produto"].str.extract(r"^([^\s-]+)")[0] # Extract ticker
+    df_filtered["Preço unitário"] = df_filtered["Preço unitário"].fillna(0)
     df_filtered = apply_ticker_renames(df_filtered, renames_file_path) # Apply renames on 'Ticker' column
 
-    df_filtered["Adjusted Quantity"] = df_filtered.apply(
-        lambda row: -row["Quantidade"] if row["Type"] == "Sell" else row["Quantidade"],
-        axis=1
-    )
-    df_filtered["Cost"] = df_filtered.apply(
-        lambda row: row["Quantidade"] * row["Preço unitário"] if row["Type"] == "Buy" else 0,
-        axis=1
-    )
+    quantity = df_filtered["Quantidade"].to_numpy()
+    transaction_type = df_filtered["Type"].to_numpy()
+    df_filtered["Adjusted Quantity"] = np.where(transaction_type == "Sell", -quantity, quantity)
+    df_filtered["Cost"] = np.where(transaction_type == "Buy", quantity * df_filtered["Preço unitário"].to_numpy(), 0.0)
     
     # Group by the 'Ticker' column which now contains potentially renamed tickers
-    grouped_df = df_filtered.groupby("Ticker").agg({
-        "Adjusted Quantity": "sum",
-        "Cost": "sum"
-    }).reset_index()
+    grouped_df = df_filtered.groupby("Ticker", observed=True, sort=False).agg(
+        Quantidade=("Adjusted Quantity", "sum"),
+        CustoTotal=("Cost", "sum")
+    ).reset_index()
 
     # Rename columns to Portuguese
-    grouped_df.columns = ["Ativo", "Quantidade", "Custo Total"] 
-    grouped_df = grouped_df[grouped_df["Quantidade"] > 0].copy() 
+    grouped_df = grouped_df.rename(columns={"Ticker": "Ativo", "CustoTotal": "Custo Total"})
+    # Only open positions remain, sorted by ticker to keep the output order stable
+    grouped_df = grouped_df[grouped_df["Quantidade"] > 0].sort_values("Ativo", ignore_index=True)
     
-    grouped_df["Preço Médio"] = grouped_df.apply(
-        lambda row: row["Custo Total"] / row["Quantidade"] if row["Quantidade"] != 0 else 0,
-        axis=1
+    grouped_df["Preço Médio"] = np.where(
+        grouped_df["Quantidade"] != 0,
+        grouped_df["Custo Total"] / grouped_df["Quantidade"],
+        0.0
     )
 
     return grouped_df[["Ativo", "Quantidade", "Preço Médio", "Custo Total"]]
 
 # --- Generate portfolio tab ---
+def _yf_symbol(ticker):
+    """
+    Returns the Yahoo Finance symbol for a ticker, adding '.SA' to Brazilian tickers if not already present.
+    """
+    if not ticker.endswith('.SA') and not '.' in ticker:
+        return f"{ticker}.SA"
+    return ticker
+
+@functools.lru_cache(maxsize=None)
 def get_current_price_yf(ticker):
     """
     Fetches the current price of a stock or FII using yfinance.
     Adds '.SA' to Brazilian tickers if not already present.
+    Results are cached per ticker for the lifetime of the process.
     """
     try:
-        if not ticker.endswith('.SA') and not '.' in ticker: 
-            ticker_sa = f"{ticker}.SA"
-        else:
-            ticker_sa = ticker
+        ticker_sa = _yf_symbol(ticker)
 
         stock_info = yf.Ticker(ticker_sa)
         current_price = stock_info.info.get('regularMarketPrice')
@@ -243,6 +480,27 @@ def get_current_price_yf(ticker):
     except Exception as e:
         print(f"Error fetching price for {ticker}: {e}")
         return None
+
+def get_current_prices_yf(tickers):
+    """
+    Fetches the latest closing price of several tickers with a single batched yfinance download.
+    Returns a dict mapping each ticker to its price. Tickers missing from the batch
+    are fetched one by one through get_current_price_yf.
+    """
+    symbols = {ticker: _yf_symbol(ticker) for ticker in tickers}
+    latest_closes = {}
+    try:
+        closes = yf.download(sorted(set(symbols.values())), period="1d", threads=True, progress=False)["Close"]
+        if isinstance(closes, pd.Series): # Older yfinance versions return a Series for a single symbol
+            closes = closes.to_frame(name=next(iter(symbols.values())))
+        latest_closes = closes.ffill().iloc[-1].dropna().to_dict() if not closes.empty else {}
+    except Exception as e:
+        print(f"Error fetching batched prices: {e}. Falling back to one request per ticker.")
+
+    prices = {}
+    for ticker, symbol in symbols.items():
+        prices[ticker] = latest_closes[symbol] if symbol in latest_closes else get_current_price_yf(ticker)
+    return prices
     
 def build_portfolio_view(position_df):
     """
@@ -255,15 +513,13 @@ def build_portfolio_view(position_df):
         return pd.DataFrame(columns=pt_columns_portfolio)
 
     print("Fetching current prices for portfolio... This may take a few seconds.")
-    df_portfolio = position_df.copy()
+    df_portfolio = position_df.copy(deep=False) # Only new columns are added, so no data needs copying
 
     # 'position_df' already has columns "Ativo", "Quantidade", "Preço Médio", "Custo Total"
-    df_portfolio['Valor Unit. Atual'] = df_portfolio['Ativo'].apply(get_current_price_yf)
+    current_prices = get_current_prices_yf(df_portfolio['Ativo'].tolist())
+    df_portfolio['Valor Unit. Atual'] = pd.to_numeric(df_portfolio['Ativo'].map(current_prices), errors='coerce')
     
-    df_portfolio['Valor Total Atual'] = df_portfolio.apply(
-        lambda row: row['Quantidade'] * row['Valor Unit. Atual'] if pd.notnull(row['Valor Unit. Atual']) else None,
-        axis=1
-    )
+    df_portfolio['Valor Total Atual'] = df_portfolio['Quantidade'] * df_portfolio['Valor Unit. Atual']
 
     df_portfolio['L/P'] = df_portfolio['Valor Total Atual'].fillna(0) - df_portfolio['Custo Total'].fillna(0)
     
@@ -275,6 +531,7 @@ def build_portfolio_view(position_df):
 def consolidate_income(transactions_df):
     """
     Consolidates dividends, JCP (Interest on Own Capital), and other income.
+    Expects the "income" slice returned by prepare_transactions.
     Returns DataFrame with columns: ["Ativo", "Ano", "Renda Total"]
     """
     print("Consolidating income...")
@@ -283,16 +540,12 @@ def consolidate_income(transactions_df):
         print("No transactions to consolidate income.")
         return pd.DataFrame(columns=pt_columns_income)
 
-    income_types = ["Dividendo", "Juros Sobre Capital Próprio", "Rendimento"]
-    df_income = transactions_df[transactions_df["Movimentação"].isin(income_types)].copy()
-    df_income["Valor da Operação"] = pd.to_numeric(df_income["Valor da Operação"], errors="coerce")
-    df_income = df_income.dropna(subset=["Valor da Operação"]).copy()
+    df_income = transactions_df.dropna(subset=["Valor da Operação"])
 
     if df_income.empty:
         print("No valid income entries found.")
         return pd.DataFrame(columns=pt_columns_income)
 
-    df_income["Ticker"] = df_income["Produto"].str.extract(r"^([^\s-]+)")[0] # Extract Ticker from Produto
     df_income["Ano"] = df_income["Data"].dt.year
 
     result_df = df_income.groupby(["Ticker", "Ano"])["Valor da Operação"].sum().reset_index()
@@ -303,6 +556,7 @@ def consolidate_income(transactions_df):
 def consolidate_sales(transactions_df):
     """
     Consolidates sales transactions.
+    Expects the "sales" slice returned by prepare_transactions.
     Returns DataFrame with columns: ["Data", "Produto", "Quantidade", "Preço unitário", "Valor da Operação"]
     """
     print("Consolidating sales...")
@@ -311,83 +565,121 @@ def consolidate_sales(transactions_df):
         print("No transactions to consolidate sales.")
         return pd.DataFrame(columns=pt_columns_sales)
 
-    df_sales = transactions_df[
-        (transactions_df["Movimentação"] == "Venda") | 
-        ((transactions_df["Movimentação"] == "Transferência - Liquidação") & (transactions_df["Entrada/Saída"] == "Debito"))
-    ].copy()
-    
-    if df_sales.empty:
-        print("No sales transactions found after filtering.")
-        return pd.DataFrame(columns=pt_columns_sales)
-
-    if "Quantidade" in df_sales.columns:
-        df_sales["Quantidade"] = pd.to_numeric(df_sales["Quantidade"], errors='coerce')
-    if "Preço unitário" in df_sales.columns:
-        df_sales["Preço unitário"] = pd.to_numeric(df_sales["Preço unitário"], errors='coerce')
-    if "Valor da Operação" in df_sales.columns:
-        df_sales["Valor da Operação"] = pd.to_numeric(df_sales["Valor da Operação"], errors='coerce')
-    
-    return df_sales[pt_columns_sales] # Columns are already in Portuguese
+    return transactions_df[pt_columns_sales] # Columns are already in Portuguese
 
 # --- Generate final Excel output ---
+def _column_width(series, header, sample_rows=200):
+    """
+    Estimates a column width from the header and the first sample_rows values.
+    Sampling avoids converting every cell to text just to measure it.
+    """
+    sample_len = series.head(sample_rows).astype(str).str.len().max() if not series.empty else 0
+    if pd.isna(sample_len):
+        sample_len = 0
+    return max(int(sample_len), len(str(header))) + 2
+
+def _sheet_rows(df_data):
+    """
+    Yields the rows of a DataFrame as tuples, with missing values as None so they become blank cells.
+    """
+    return df_data.astype(object).where(df_data.notna(), None).itertuples(index=False, name=None)
+
+def _write_output_pyexcelerate(sheets_data, currency_columns_map, output_path):
+    """
+    Writes the output sheets with PyExcelerate.
+    """
+    workbook = pyexcelerate.Workbook()
+    header_style = pyexcelerate.Style(font=pyexcelerate.Font(bold=True))
+    money_format = pyexcelerate.Format('R$ #,##0.00')
+    date_format = pyexcelerate.Format('YYYY-MM-DD HH:MM:SS')
+
+    for sheet_name, df_data in sheets_data.items():
+        if df_data is None or df_data.empty:
+            worksheet = workbook.new_sheet(sheet_name)
+            # Default width for an empty sheet's first column
+            worksheet.set_col_style(1, pyexcelerate.Style(size=20))
+            continue
+
+        data = [[str(col_name) for col_name in df_data.columns]]
+        data.extend(_sheet_rows(df_data))
+        worksheet = workbook.new_sheet(sheet_name, data=data)
+
+        # Get the list of currency columns for the current sheet
+        sheet_currency_columns = currency_columns_map.get(sheet_name, [])
+        for idx, col_name in enumerate(df_data.columns, start=1): # PyExcelerate columns are 1-based
+            if col_name in sheet_currency_columns:
+                column_format = money_format
+            elif pd.api.types.is_datetime64_any_dtype(df_data[col_name]):
+                column_format = date_format
+            else:
+                column_format = None
+            worksheet.set_col_style(idx, pyexcelerate.Style(size=_column_width(df_data[col_name], col_name), format=column_format))
+        worksheet.set_row_style(1, header_style)
+
+    workbook.save(output_path)
+
+def _write_output_xlsxwriter(sheets_data, currency_columns_map, output_path):
+    """
+    Writes the output sheets with xlsxwriter.
+    Rows are streamed to disk with constant_memory mode, so column widths and
+    formats are set before any row of a sheet is written.
+    """
+    workbook = xlsxwriter.Workbook(output_path, {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'default_date_format': 'YYYY-MM-DD HH:MM:SS'
+    })
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    money_format = workbook.add_format({'num_format': 'R$ #,##0.00'}) 
+
+    for sheet_name, df_data in sheets_data.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        if df_data is None or df_data.empty:
+            # Default width for an empty sheet's first column
+            worksheet.set_column(0, 0, 20) 
+            continue
+
+        # Get the list of currency columns for the current sheet
+        sheet_currency_columns = currency_columns_map.get(sheet_name, [])
+
+        # Apply width and format together, before writing, as constant_memory flushes each row once written
+        for idx, col_name in enumerate(df_data.columns):
+            current_format_to_apply = money_format if col_name in sheet_currency_columns else None
+            worksheet.set_column(idx, idx, _column_width(df_data[col_name], col_name), current_format_to_apply)
+
+        worksheet.write_row(0, 0, [str(col_name) for col_name in df_data.columns], header_format)
+        for row_idx, row in enumerate(_sheet_rows(df_data), start=1):
+            worksheet.write_row(row_idx, 0, row)
+
+    workbook.close()
+
 def generate_output_excel(portfolio_df, position_df, sales_df, income_df, output_path):
     """
     Generates the final Excel output file with four sheets and applies currency formatting.
+    Uses EXCEL_WRITE_ENGINE to write the workbook.
     """
     print(f"Generating output file: {output_path}")
     try:
-        with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
-            
-            sheets_data = {
-                "Portfolio": portfolio_df,
-                "Posicao_Custo": position_df, 
-                "Vendas_Log": sales_df,       
-                "Rendimentos_Log": income_df  
-            }
-
-            for sheet_name, df_to_write in sheets_data.items():
-                if df_to_write is not None and not df_to_write.empty:
-                    df_to_write.to_excel(writer, sheet_name=sheet_name, index=False)
-                else:
-                    pd.DataFrame().to_excel(writer, sheet_name=sheet_name, index=False)
-
-            workbook = writer.book
-            money_format = workbook.add_format({'num_format': 'R$ #,##0.00'}) 
-
-            # Define which columns need currency format for each sheet
-            # Ensures that the formatting is applied correctly with Portuguese column names
-            currency_columns_map = {
-                "Portfolio": ['Preço Médio', 'Custo Total', 'Valor Unit. Atual', 'Valor Total Atual', 'L/P'],
-                "Posicao_Custo": ['Preço Médio', 'Custo Total'],
-                "Vendas_Log": ['Preço unitário', 'Valor da Operação'],
-                "Rendimentos_Log": ['Renda Total']
-            }
-            
-            # Auto-adjust column widths and apply formats in a single loop
-            # This prevents the width adjustment from overriding the cell format
-            for sheet_name, df_data in sheets_data.items():
-                if sheet_name in writer.sheets: 
-                    worksheet = writer.sheets[sheet_name]
-                    if df_data is not None and not df_data.empty:
-                        # Get the list of currency columns for the current sheet
-                        sheet_currency_columns = currency_columns_map.get(sheet_name, [])
-
-                        for idx, col_name in enumerate(df_data.columns): # col_name is the actual column name from DataFrame
-                            series = df_data[col_name]
-                            # Calculate max length for column width
-                            max_data_len = series.astype(str).map(len).max() if not series.empty else 0
-                            header_len = len(str(col_name))
-                            max_len = max(max_data_len, header_len) + 2  
-                            
-                            current_format_to_apply = None
-                            if col_name in sheet_currency_columns:
-                                current_format_to_apply = money_format
-                            
-                            # Apply width and format together
-                            worksheet.set_column(idx, idx, max_len, current_format_to_apply)
-                    else: 
-                        # Default width for an empty sheet's first column if sheet was created empty
-                        worksheet.set_column(0, 0, 20) 
+        sheets_data = {
+            "Portfolio": portfolio_df,
+            "Posicao_Custo": position_df, 
+            "Vendas_Log": sales_df,       
+            "Rendimentos_Log": income_df  
+        }
+
+        # Define which columns need currency format for each sheet
+        # Ensures that the formatting is applied correctly with Portuguese column names
+        currency_columns_map = {
+            "Portfolio": ['Preço Médio', 'Custo Total', 'Valor Unit. Atual', 'Valor Total Atual', 'L/P'],
+            "Posicao_Custo": ['Preço Médio', 'Custo Total'],
+            "Vendas_Log": ['Preço unitário', 'Valor da Operação'],
+            "Rendimentos_Log": ['Renda Total']
+        }
+
+        if EXCEL_WRITE_ENGINE == "pyexcelerate":
+            _write_output_pyexcelerate(sheets_data, currency_columns_map, output_path)
+        else:
+            _write_output_xlsxwriter(sheets_data, currency_columns_map, output_path)
 
         print("\nSUCCESS: Output file generated successfully!")
     except Exception as e:
@@ -437,14 +729,16 @@ if __name__ == "__main__":
         else:
             splits_df = load_splits_and_groupings(splits_file_path)
             
-            processed_transactions_df = apply_splits_and_groupings(all_transactions_df.copy(), cutoff_date, splits_df)
+            processed_transactions_df = apply_splits_and_groupings(all_transactions_df, cutoff_date, splits_df)
+
+            transactions_by_use = prepare_transactions(processed_transactions_df)
 
-            position_cost_basis_df = consolidate_position(processed_transactions_df.copy(), cutoff_date, renames_file_path)
+            position_cost_basis_df = consolidate_position(transactions_by_use["buys_sells"], cutoff_date, renames_file_path)
             
-            sales_log_df = consolidate_sales(processed_transactions_df.copy())
-            income_log_df = consolidate_income(processed_transactions_df.copy())
+            sales_log_df = consolidate_sales(transactions_by_use["sales"])
+            income_log_df = consolidate_income(transactions_by_use["income"])
             
-            portfolio_market_view_df = build_portfolio_view(position_cost_basis_df.copy()) 
+            portfolio_market_view_df = build_portfolio_view(position_cost_basis_df) 
 
             generate_output_excel(portfolio_market_view_df, position_cost_basis_df, sales_log_df, income_log_df, output_file_path)
             